@@ -2,12 +2,12 @@
 #define MOTOR_F 10
 #define MOTOR_B 11
 #define PARSE_INDICATOR 2
-#define PACKET_SIZE 8
+#define PACKET_SIZE 40
 
 #define DEFAULT_INTENSITY 128
 
 /**
- * In intensity mode, the front and back motors are driven using a 
+ * In intensity mode, the front and back motors are driven using a
  * linear relationship between the PWM rate and the value given on
  * the serial port. The value 0 is "off", and 255 is the highest
  * intensity vibration.
@@ -15,24 +15,46 @@
 #define INTENSITY 1
 
 /**
- * In frequency mode the values for the motors control the duration
- * between pulses at maximum intensity, with 0 being the longest 
- * duration and 255 the shortest.
+ * In frequency mode the motors are pulsed at maximum intensity
+ * following a waveform (period, duty and ramp) for each motor. The
+ * waveform is either sent directly as a descriptor, or derived from
+ * a value, with 0 being the longest duration between pulses and 255
+ * the shortest.
  */
 #define FREQUENCY 2
 #define FREQ_MODE_PULSE_WIDTH 50
+#define FREQ_MODE_MS_PER_STEP 4
+
+/**
+ * A pulse waveform for one motor. Pin toggles are scheduled as
+ * deadlines against micros(), and each deadline is advanced from the
+ * last one (not from when it was noticed), so pulse timing doesn't
+ * drift or depend on what else loop() is doing.
+ */
+struct Waveform {
+  int pin;
+  int state;
+  unsigned long period;        // ms, 0 is off
+  unsigned long start_period;  // ms, period when the current ramp began
+  unsigned long target_period; // ms
+  unsigned long ramp;          // ms taken to glide from start_period to target_period
+  unsigned long ramp_start;    // micros() when the current ramp began
+  int duty;                    // fraction of the period spent HIGH, out of 255
+  unsigned long next_toggle;   // micros() deadline of the next toggle
+};
 
 int mode = INTENSITY;
-int front_state = LOW;
-long last_front_state_change = 0;
-int back_state = LOW;
-long last_back_state_change = 0;
 
 int front_value = 0;
 int back_value = 0;
 
-char front_buf[PACKET_SIZE + 1];
-char back_buf[PACKET_SIZE + 1];
+Waveform front_wave = { MOTOR_F, LOW, 0, 0, 0, 0, 0, 0, 0 };
+Waveform back_wave = { MOTOR_B, LOW, 0, 0, 0, 0, 0, 0, 0 };
+
+// Packet being received, and the character that will end it (0 if none)
+char packet_buf[PACKET_SIZE + 1];
+int packet_len = 0;
+char packet_end = 0;
 
 void setup() {
   Serial.begin(115200);
@@ -48,94 +70,198 @@ void loop() {
 
 void read_values() {
   // Look for value commands, which look like {FFF;BBB}
-  // (e.g. {124;256} to set the front to value 124 and 
-  //  the back to value 256)
+  // (e.g. {124;256} to set the front to value 124 and
+  //  the back to value 256), and waveform commands, which look
+  // like [PPPPP;DDD;RRRRR;PPPPP;DDD;RRRRR] (period in ms, duty
+  // out of 255 and ramp in ms for the front, then the back) and
+  // only apply in frequency mode.
+  //
+  // Only the bytes that have already arrived are read, so a packet
+  // split across several calls never stalls the motors.
   while (Serial.available() > 0) {
     int in_byte = Serial.read();
 
-     if (in_byte == 'I') {
-      mode = INTENSITY;
+    if (packet_end != 0) {
+      if (in_byte == packet_end) { // Yay! A full packet arrived.
+        packet_buf[packet_len] = 0;
+        digitalWrite(PARSE_INDICATOR, LOW);
+        handle_packet(packet_end);
+        packet_end = 0;
+      } else if (packet_len < PACKET_SIZE) {
+        packet_buf[packet_len++] = in_byte;
+      } else {
+        // Too long to be a packet; drop it
+        digitalWrite(PARSE_INDICATOR, LOW);
+        packet_end = 0;
+      }
+    } else if (in_byte == 'I') {
+      // Waveforms never touch the values, so leaving frequency mode
+      // starts from off rather than from the last value before it
+      // (hosts send values every frame in intensity mode)
+      if (mode != INTENSITY) {
+        mode = INTENSITY;
+        front_value = 0;
+        back_value = 0;
+      }
     } else if (in_byte == 'F') {
-      mode = FREQUENCY;
-      last_front_state_change = millis();
-      last_back_state_change = millis();
-      front_state = LOW;
-      back_state = LOW;
-    } else if (in_byte == '{') {
+      // Hosts resend 'F' with each waveform in case we were reset, so
+      // it only restarts the pulses when switching modes
+      if (mode != FREQUENCY) {
+        mode = FREQUENCY;
+        stop_waveform(&front_wave);
+        stop_waveform(&back_wave);
+        set_waveform_from_value(&front_wave, front_value);
+        set_waveform_from_value(&back_wave, back_value);
+      }
+    } else if (in_byte == '{' || in_byte == '[') {
       digitalWrite(PARSE_INDICATOR, HIGH);
+      packet_end = (in_byte == '{') ? '}' : ']';
+      packet_len = 0;
+    }
+  }
+}
 
-      // Initialize read buffers to 0
-      memset(front_buf, 0, sizeof(front_buf));
-      memset(back_buf, 0, sizeof(back_buf));
-      int success = 0;
+void handle_packet(char end) {
+  long fields[6];
+  int count = parse_fields(fields, 6);
 
-      // Parse the first part of the packet
-      for (int i = 0; i < PACKET_SIZE; i++) {
-        while (!Serial.available()) {
-          // Wait for data to become available
-        }
+  if (end == '}' && count == 2) {
+    front_value = fields[0];
+    back_value = fields[1];
+    if (mode == FREQUENCY) {
+      set_waveform_from_value(&front_wave, front_value);
+      set_waveform_from_value(&back_wave, back_value);
+    }
+  } else if (end == ']' && count == 6 && mode == FREQUENCY) {
+    // (waveforms are only for frequency mode; outside it they're ignored)
+    set_waveform(&front_wave, fields[0], fields[1], fields[2]);
+    set_waveform(&back_wave, fields[3], fields[4], fields[5]);
+  }
+}
 
-        in_byte = Serial.read();
+/**
+ * Parse the ';' separated numbers in packet_buf, returning how many
+ * were found (at most max_fields).
+ */
+int parse_fields(long *fields, int max_fields) {
+  int count = 0;
+  char *field = packet_buf;
 
-        if (in_byte == ';') {
-          break;
-        } else {
-          front_buf[i] = in_byte;
-        }
-      }
-      
-      for (int i = 0; i < PACKET_SIZE; i++) {
-        while (!Serial.available()) {
-          // Wait for data to become available
-        }
-        in_byte = Serial.read();
-
-        if (in_byte == '}') { // Yay! A full packet arrived.
-          success = 1;
-          break;
-        } else {
-          back_buf[i] = in_byte;
-        }
-      }
-      digitalWrite(PARSE_INDICATOR, LOW);
-      
-      if (success) {
-        front_value = atoi(front_buf);
-        back_value = atoi(back_buf);
-      } else {
-        continue;
-      }
+  while (count < max_fields) {
+    fields[count++] = atol(field);
+    field = strchr(field, ';');
+    if (field == NULL) {
+      break;
     }
+    field++;
   }
+  return count;
 }
 
 void update_motors() {
-   if (mode == INTENSITY) {
+  if (mode == INTENSITY) {
     analogWrite(MOTOR_F, front_value);
     analogWrite(MOTOR_B, back_value);
   } else {
-    if (last_front_state_change + delay_from_value(front_state, front_value) < millis()) {
-      front_state = !front_state;
-      digitalWrite(MOTOR_F, front_state);
-      last_front_state_change = millis();
-    }
+    unsigned long now = micros();
+    update_waveform(&front_wave, now);
+    update_waveform(&back_wave, now);
+  }
+}
 
-    if (last_back_state_change + delay_from_value(back_state, back_value) < millis()) {
-      back_state = !back_state;
-      digitalWrite(MOTOR_B, back_state);
-      last_back_state_change = millis();
-    }
+/**
+ * Switch a motor off and forget its waveform.
+ */
+void stop_waveform(Waveform *wave) {
+  wave->period = 0;
+  wave->start_period = 0;
+  wave->target_period = 0;
+  wave->ramp = 0;
+  wave->state = LOW;
+  digitalWrite(wave->pin, LOW);
+}
+
+/**
+ * Start a motor gliding to a new waveform. Resending the waveform a
+ * motor already has leaves its pulses undisturbed.
+ */
+void set_waveform(Waveform *wave, long period, long duty, long ramp) {
+  period = max(period, 0L);
+  duty = constrain(duty, 0L, 255L);
+  ramp = max(ramp, 0L);
+
+  if (period == (long)wave->target_period && duty == wave->duty) {
+    return;
   }
+
+  if (period == 0) {
+    stop_waveform(wave);
+    return;
+  }
+
+  // A motor that was off starts its first pulse now, at the new period
+  if (wave->period == 0) {
+    wave->period = period;
+    wave->ramp = 0;
+    wave->next_toggle = micros();
+  } else {
+    wave->ramp = ramp;
+  }
+
+  wave->start_period = wave->period;
+  wave->target_period = period;
+  wave->ramp_start = micros();
+  wave->duty = duty;
 }
 
 /**
- * Get the delay in milliseconds that the frequency mode should 
- * wait for a given value.
+ * Set a motor's waveform from a value: a FREQ_MODE_PULSE_WIDTH ms
+ * pulse, then FREQ_MODE_MS_PER_STEP ms off for each step below 255.
  */
-int delay_from_value(int state, int value) {
-  if (state == HIGH) {
-    return FREQ_MODE_PULSE_WIDTH;
+void set_waveform_from_value(Waveform *wave, int value) {
+  long period = FREQ_MODE_PULSE_WIDTH + (255L - value) * FREQ_MODE_MS_PER_STEP;
+  long duty = (255L * FREQ_MODE_PULSE_WIDTH + period / 2) / period;
+  set_waveform(wave, period, duty, 0);
+}
+
+/**
+ * Toggle a motor's pin if its next deadline has passed.
+ */
+void update_waveform(Waveform *wave, unsigned long now) {
+  if (wave->period == 0 || (long)(now - wave->next_toggle) < 0) {
+    return;
+  }
+
+  // Move the period along its ramp
+  unsigned long ramp_elapsed = (now - wave->ramp_start) / 1000;
+  if (ramp_elapsed >= wave->ramp) {
+    wave->period = wave->target_period;
+    wave->start_period = wave->target_period;
+    wave->ramp = 0;
   } else {
-    return (255 - value) * 4;
+    float t = (float)ramp_elapsed / wave->ramp;
+    wave->period = wave->start_period + ((float)wave->target_period - wave->start_period) * t;
+  }
+
+  // (period * duty * 1000 would overflow for periods over ~16 seconds)
+  unsigned long period_us = wave->period * 1000;
+  unsigned long period_duty = wave->period * wave->duty;
+  unsigned long high_us = period_duty / 255 * 1000 + (period_duty % 255) * 1000 / 255;
+  unsigned long low_us = period_us - high_us;
+
+  // Fully on and fully off waveforms never toggle
+  if (high_us == 0) {
+    wave->state = HIGH;
+  } else if (low_us == 0) {
+    wave->state = LOW;
+  }
+
+  wave->state = !wave->state;
+  digitalWrite(wave->pin, wave->state);
+  wave->next_toggle += (wave->state == HIGH) ? high_us : low_us;
+
+  // If we've fallen more than a whole period behind, start afresh
+  if ((long)(now - wave->next_toggle) > (long)period_us) {
+    wave->next_toggle = now;
   }
 }
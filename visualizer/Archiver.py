@@ -0,0 +1,411 @@
+from array import array
+import csv
+import glob
+import json
+import lzma
+import os
+import struct
+import sys
+import zlib
+
+
+# =================================
+# CONSTANTS
+# =================================
+# file layout: MAGIC, chunks..., index, trailer
+ARCHIVE_MAGIC = b"HSEARC1\n"
+TRAILER_FORMAT = "<QQ8s"  # index offset, index length, magic
+TRAILER_SIZE = struct.calcsize(TRAILER_FORMAT)
+# chunks
+CHUNK_ROWS = 1024  # rows per independently compressed chunk (~17 seconds at 60 Hz)
+CHUNK_COLUMN_FORMAT = "<cI"  # column kind, number of bytes
+CHUNK_COLUMN_SIZE = struct.calcsize(CHUNK_COLUMN_FORMAT)
+COLUMN_KIND_NUMBER = b"d"  # written as format_number() writes them
+COLUMN_KIND_FIXED = b"f"  # written with a fixed number of decimals (first byte of the column data)
+COLUMN_KIND_TEXT = b"t"
+TEXT_SEPARATOR = "\x00"
+# compression
+COMPRESSION_LZMA = "lzma"
+COMPRESSION_ZLIB = "zlib"
+DEFAULT_COMPRESSION = COMPRESSION_LZMA
+ZLIB_OPTION = "--zlib"
+COMPRESSORS = {
+    COMPRESSION_LZMA: lzma.compress,
+    COMPRESSION_ZLIB: lambda data: zlib.compress(data, 9),
+}
+DECOMPRESSORS = {
+    COMPRESSION_LZMA: lzma.decompress,
+    COMPRESSION_ZLIB: zlib.decompress,
+}
+USAGE = """usage:
+  py Archiver.py pack [--zlib] [archive] [csv files...]
+      adds logs to the archive (creating it if needed; --zlib only applies to new archives)
+  py Archiver.py list [archive]
+      lists the sessions in the archive
+  py Archiver.py extract [archive] [session] [output csv] [start] [end]
+      writes a session (optionally only rows with start <= Time <= end, in ms) to a new csv file"""
+
+
+# =================================
+# HELPERS
+# =================================
+def parse_number(text: str):
+    """returns text as a float, or None if it isn't one"""
+
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def format_number(value: float) -> str:
+    """formats a float the way the visualizer writes it (no trailing .0 on whole numbers)"""
+
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def count_decimals(text: str) -> int:
+    """returns the number of digits after the decimal point in text"""
+
+    _, point, decimals = text.partition(".")
+    return len(decimals) if point else 0
+
+
+# =================================
+# CHUNKS
+# =================================
+def encode_chunk(columns: list) -> (bytes, float, float):
+    """packs column lists into chunk bytes, returns (data, first time, last time)
+
+    columns of numbers that can be written back exactly as they were are stored as float64 arrays,
+    the rest as text"""
+
+    data = bytearray()
+    firstTime = None
+    lastTime = None
+
+    for columnIndex in range(len(columns)):
+        values = columns[columnIndex]
+        numbers = [parse_number(value) for value in values]
+
+        # store as numbers if we can (compresses and reads much better than text)
+        kind = COLUMN_KIND_TEXT
+        if None not in numbers:
+            decimals = count_decimals(values[0]) if len(values) > 0 else 0
+            if all(format_number(numbers[i]) == values[i] for i in range(len(values))):
+                kind = COLUMN_KIND_NUMBER
+                columnData = array('d', numbers).tobytes()
+            elif decimals < 256 and all(format("%.*f" % (decimals, numbers[i])) == values[i]
+                                        for i in range(len(values))):
+                kind = COLUMN_KIND_FIXED
+                columnData = bytes((decimals,)) + array('d', numbers).tobytes()
+
+        if kind == COLUMN_KIND_TEXT:
+            columnData = TEXT_SEPARATOR.join(values).encode('utf-8')
+        elif columnIndex == 0 and len(numbers) > 0:
+            firstTime = min(numbers)
+            lastTime = max(numbers)
+
+        data += struct.pack(CHUNK_COLUMN_FORMAT, kind, len(columnData))
+        data += columnData
+
+    return (bytes(data), firstTime, lastTime)
+
+
+def decode_chunk(data: bytes, columnCount: int, rowCount: int, asText: bool = False) -> list:
+    """unpacks chunk bytes into column lists (numbers as floats, or as the original text if asText)"""
+
+    columns = []
+    offset = 0
+
+    for columnIndex in range(columnCount):
+        kind, length = struct.unpack_from(CHUNK_COLUMN_FORMAT, data, offset)
+        offset = offset + CHUNK_COLUMN_SIZE
+        columnData = data[offset:offset + length]
+        offset = offset + length
+
+        if kind == COLUMN_KIND_NUMBER:
+            values = array('d')
+            values.frombytes(columnData)
+            if asText:
+                values = [format_number(value) for value in values]
+        elif kind == COLUMN_KIND_FIXED:
+            decimals = columnData[0]
+            values = array('d')
+            values.frombytes(columnData[1:])
+            if asText:
+                values = [format("%.*f" % (decimals, value)) for value in values]
+        elif rowCount > 0:
+            values = columnData.decode('utf-8').split(TEXT_SEPARATOR)
+        else:
+            values = []
+        columns.append(values)
+
+    return columns
+
+
+# =================================
+# READING
+# =================================
+def open_archive(archivePath: str) -> dict:
+    """reads the index of an archive"""
+
+    with open(archivePath, 'rb') as archiveFile:
+        if archiveFile.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            raise ValueError("%s is not a session archive" % archivePath)
+
+        archiveFile.seek(-TRAILER_SIZE, os.SEEK_END)
+        indexOffset, indexLength, magic = struct.unpack(TRAILER_FORMAT, archiveFile.read(TRAILER_SIZE))
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError("%s is truncated or corrupt" % archivePath)
+
+        archiveFile.seek(indexOffset)
+        index = json.loads(zlib.decompress(archiveFile.read(indexLength)).decode('utf-8'))
+
+    index["path"] = archivePath
+    index["indexOffset"] = indexOffset
+    return index
+
+
+def find_session(index: dict, sessionName: str) -> dict:
+    """returns the index entry for a session"""
+
+    for session in index["sessions"]:
+        if session["name"] == sessionName:
+            return session
+
+    raise KeyError("no session named %s in %s" % (sessionName, index["path"]))
+
+
+def iter_session_columns(index: dict, sessionName: str, startTime: float = None, endTime: float = None,
+                         asText: bool = False):
+    """yields the columns of each chunk of a session that may hold rows in [startTime, endTime]
+
+    only those chunks are read and decompressed"""
+
+    session = find_session(index, sessionName)
+    decompress = DECOMPRESSORS[index["compression"]]
+    columnCount = len(session["columns"])
+
+    with open(index["path"], 'rb') as archiveFile:
+        for chunk in session["chunks"]:
+
+            # skip chunks entirely outside the requested time range
+            if chunk["firstTime"] is not None:
+                if startTime is not None and chunk["lastTime"] < startTime:
+                    continue
+                if endTime is not None and chunk["firstTime"] > endTime:
+                    continue
+
+            archiveFile.seek(chunk["offset"])
+            data = decompress(archiveFile.read(chunk["length"]))
+            yield decode_chunk(data, columnCount, chunk["rows"], asText)
+
+
+def iter_session_rows(index: dict, sessionName: str, startTime: float = None, endTime: float = None,
+                      asText: bool = False):
+    """yields the rows of a session, optionally only those with startTime <= Time <= endTime"""
+
+    for columns in iter_session_columns(index, sessionName, startTime, endTime, asText):
+        for row in zip(*columns):
+
+            # filter rows on the (numeric) first column
+            if startTime is not None or endTime is not None:
+                rowTime = row[0] if isinstance(row[0], float) else parse_number(row[0])
+                if rowTime is None:
+                    continue
+                if startTime is not None and rowTime < startTime:
+                    continue
+                if endTime is not None and rowTime > endTime:
+                    continue
+
+            yield row
+
+
+def iter_archive_rows(index: dict):
+    """yields (session name, row) for every row in the archive"""
+
+    for session in index["sessions"]:
+        for row in iter_session_rows(index, session["name"]):
+            yield (session["name"], row)
+
+
+# =================================
+# WRITING
+# =================================
+def read_csv_columns(csvPath: str) -> (list, list):
+    """reads a log csv, returns (header, rows)"""
+
+    with open(csvPath, newline='') as csvfile:
+        rows = list(csv.reader(csvfile))
+
+    if len(rows) == 0:
+        return ([], [])
+    return (rows[0], rows[1:])
+
+
+def pack_session(sessionName: str, header: list, rows: list, compression: str) -> (dict, list):
+    """compresses a session's rows into chunks, returns (its index entry, the compressed chunks)
+
+    chunk offsets are filled in when the chunks are written"""
+
+    compress = COMPRESSORS[compression]
+    chunks = []
+    chunkData = []
+
+    for chunkStart in range(0, len(rows), CHUNK_ROWS):
+        chunkRows = rows[chunkStart:chunkStart + CHUNK_ROWS]
+
+        # transpose the rows into columns (padding short rows)
+        columns = [[row[i] if i < len(row) else "" for row in chunkRows] for i in range(len(header))]
+        data, firstTime, lastTime = encode_chunk(columns)
+        compressed = compress(data)
+
+        chunks.append({
+            "offset": None,
+            "length": len(compressed),
+            "rows": len(chunkRows),
+            "firstTime": firstTime,
+            "lastTime": lastTime,
+        })
+        chunkData.append(compressed)
+
+    return ({"name": sessionName, "columns": header, "rows": len(rows), "chunks": chunks}, chunkData)
+
+
+def pack_archive(archivePath: str, csvPaths: list, compression: str = None):
+    """adds csv logs to an archive as sessions named after the files, creating it if needed
+
+    new data is only appended, and cut off again if anything fails, so a failure leaves the archive as it was"""
+
+    # start a new archive, or add to an existing one (whose compression must be kept)
+    if os.path.exists(archivePath):
+        index = open_archive(archivePath)
+        if compression is not None and compression != index["compression"]:
+            raise ValueError("%s is a %s archive; it can't have %s sessions added"
+                             % (archivePath, index["compression"], compression))
+    else:
+        index = {"compression": compression or DEFAULT_COMPRESSION, "sessions": []}
+
+    # read and compress every log before touching the archive
+    existingNames = set(session["name"] for session in index["sessions"])
+    newSessions = []
+    for csvPath in csvPaths:
+        sessionName = os.path.splitext(os.path.basename(csvPath))[0]
+        if sessionName in existingNames:
+            print("Skipping", csvPath, "(already archived)")
+            continue
+
+        header, rows = read_csv_columns(csvPath)
+        newSessions.append(pack_session(sessionName, header, rows, index["compression"]))
+        existingNames.add(sessionName)
+
+    # append after the existing archive (its old index stays valid until the new trailer is written)
+    if "indexOffset" in index:
+        archiveFile = open(archivePath, 'r+b')
+        originalLength = archiveFile.seek(0, os.SEEK_END)
+    else:
+        archiveFile = open(archivePath, 'wb')
+        originalLength = None
+
+    try:
+        with archiveFile:
+            if originalLength is None:
+                archiveFile.write(ARCHIVE_MAGIC)
+
+            # write each new session's chunks
+            sessions = list(index["sessions"])
+            for session, chunkData in newSessions:
+                for chunk, compressed in zip(session["chunks"], chunkData):
+                    chunk["offset"] = archiveFile.tell()
+                    archiveFile.write(compressed)
+                sessions.append(session)
+
+            # write the index and trailer
+            indexOffset = archiveFile.tell()
+            storedIndex = {"compression": index["compression"], "sessions": sessions}
+            indexData = zlib.compress(json.dumps(storedIndex).encode('utf-8'), 9)
+            archiveFile.write(indexData)
+            archiveFile.write(struct.pack(TRAILER_FORMAT, indexOffset, len(indexData), ARCHIVE_MAGIC))
+
+    # on failure, cut the archive back to how it was
+    except BaseException:
+        if originalLength is None:
+            os.remove(archivePath)
+        else:
+            os.truncate(archivePath, originalLength)
+        raise
+
+
+def extract_session(index: dict, sessionName: str, csvPath: str, startTime: float = None, endTime: float = None):
+    """writes a session (or part of it) to a new csv file, exactly as it was packed
+
+    refuses to overwrite an existing file"""
+
+    session = find_session(index, sessionName)
+
+    with open(csvPath, 'x', newline='') as csvfile:
+        logWriter = csv.writer(csvfile)
+        logWriter.writerow(session["columns"])
+        logWriter.writerows(iter_session_rows(index, sessionName, startTime, endTime, asText=True))
+
+
+# =================================
+# GENERAL
+# =================================
+def main(argv):
+    """command line entry point"""
+
+    command = argv[0] if len(argv) > 0 else None
+    arguments = argv[1:]
+
+    # pull out options
+    compression = None
+    if command == "pack" and len(arguments) > 0 and arguments[0] == ZLIB_OPTION:
+        compression = COMPRESSION_ZLIB
+        arguments = arguments[1:]
+
+    try:
+        if command == "pack" and len(arguments) >= 2:
+
+            # expand wildcards ourselves (the windows command prompt doesn't)
+            csvPaths = []
+            for pattern in arguments[1:]:
+                csvPaths.extend(sorted(glob.glob(pattern)) or [pattern])
+
+            pack_archive(arguments[0], csvPaths, compression)
+
+        elif command == "list" and len(arguments) == 1:
+            index = open_archive(arguments[0])
+            for session in index["sessions"]:
+                print(session["name"], session["rows"], "rows", len(session["chunks"]), "chunks")
+
+        elif command == "extract" and len(arguments) in (3, 4, 5):
+
+            # catch a forgotten output path, which would otherwise take the start time's place
+            if not arguments[2].lower().endswith(".csv"):
+                raise ValueError("output file %s should end in .csv" % arguments[2])
+
+            index = open_archive(arguments[0])
+            startTime = float(arguments[3]) if len(arguments) > 3 else None
+            endTime = float(arguments[4]) if len(arguments) > 4 else None
+            extract_session(index, arguments[1], arguments[2], startTime, endTime)
+
+        else:
+            print(USAGE)
+            return 1
+
+    except (OSError, ValueError, KeyError) as error:
+        print("ERROR:", error)
+        return 1
+
+    return 0
+
+
+# =================================
+# STARTUP
+# =================================
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,345 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import time
+
+import Visualizer
+from Visualizer import pygame
+
+
+# =================================
+# CONSTANTS
+# =================================
+# app
+FRAME_INTERVAL = 1/Visualizer.FRAME_RATE  # seconds
+# serial communication
+SERIAL_READ_SIZE = 256  # bytes
+# telemetry (enabled with the telemetry=[port] command line option)
+TELEMETRY_HOST = "127.0.0.1"
+TELEMETRY_MAX_BUFFER = 64 * 1024  # bytes; slower clients are dropped
+
+
+# =================================
+# VARS
+# =================================
+# app
+loop = None
+pygameExecutor = None  # every pygame call happens on this executor's one thread
+frameTicks = 0  # pygame.time.get_ticks() at the end of the last frame, for use off the pygame thread
+# serial communication
+serialFd = None  # non-blocking descriptor of the serial port, if the platform has one
+serialExecutor = None  # used for writes when there's no descriptor (e.g. windows)
+serialWriteLock = None
+serialReadBuffer = bytearray()
+# telemetry
+telemetryServer = None
+telemetryWriters = []
+
+
+# =================================
+# SERIAL COMMUNICATION
+# =================================
+class SerialTaskHandle:
+    """lets Visualizer join() the serial communication task like it would the serial thread"""
+
+    def __init__(self, future):
+        self.future = future
+
+    def join(self):
+        # like a thread that died, a failed task still joins, so the test's logs still get written
+        try:
+            self.future.result()
+        except Exception as error:
+            print("ERROR: Serial communication failed:", repr(error))
+
+
+def get_serial_fd():
+    """returns the serial port's (non-blocking) file descriptor, or None if it doesn't have one"""
+
+    try:
+        return Visualizer.serialObject.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+async def wait_until_writable(fd: int):
+    """waits for fd to accept more data"""
+
+    writable = loop.create_future()
+    loop.add_writer(fd, lambda: writable.done() or writable.set_result(None))
+    try:
+        await writable
+    finally:
+        loop.remove_writer(fd)
+
+
+async def write_serial_message_async(getMessage) -> (float, float):
+    """async equivalent of Visualizer.write_serial_message, without blocking the loop
+
+    getMessage is called while holding serialWriteLock (every write happens on the loop, so that's enough
+    to see the band's state as of this write)"""
+
+    async with serialWriteLock:
+        toSend = getMessage()
+        if toSend is None:
+            return None
+        message, command, front, back = toSend
+
+        sendTime = time.perf_counter()
+
+        # write through the descriptor, waiting whenever the port's buffer is full
+        if serialFd is not None:
+            remaining = memoryview(bytes(message))
+            while len(remaining) > 0:
+                try:
+                    remaining = remaining[os.write(serialFd, remaining):]
+                except BlockingIOError:
+                    await wait_until_writable(serialFd)
+
+        # otherwise fall back to a blocking write off the loop
+        else:
+            await loop.run_in_executor(serialExecutor, Visualizer.serialObject.write, message)
+
+        duration = time.perf_counter() - sendTime
+
+        with Visualizer.serialWriteLock:
+            Visualizer.note_serial_message_sent(message, sendTime, duration, command, front, back)
+
+    return (sendTime, duration)
+
+
+def write_serial_message_from_thread(getMessage) -> (float, float):
+    """Visualizer.serialMessageWriter - writes from the pygame thread via the loop"""
+
+    future = asyncio.run_coroutine_threadsafe(write_serial_message_async(getMessage), loop)
+    return future.result()
+
+
+async def send_vibration_values_async(frontValue: int, backValue: int) -> (float, float):
+    """sends front and back vibration values to the arduino, returns None if nothing needed sending"""
+
+    return await write_serial_message_async(lambda: Visualizer.get_vibration_message(frontValue, backValue))
+
+
+async def serial_communication_task():
+    """async equivalent of Visualizer.serial_communication_thread"""
+
+    nextSendTime = loop.time()
+
+    # so long as test is still active
+    while Visualizer.goalTestActive and Visualizer.serialObject is not None:
+
+        # take the latest input sample
+        inputTime, pollInterval, user = Visualizer.userInputSample
+        calculateTime = time.perf_counter()
+
+        # calculate what values to pass
+        frontValue, backValue = Visualizer.calculate_vibration_values(user)
+
+        # send the message (if the band doesn't already have it)
+        writeTiming = await send_vibration_values_async(frontValue, backValue)
+
+        # trace how long the input took to get here
+        if Visualizer.latencyTracingEnabled:
+            Visualizer.record_latency_trace(inputTime, pollInterval, calculateTime, writeTiming)
+
+        # wait until the next send is due (catching up rather than bursting if we fell behind)
+        nextSendTime = max(nextSendTime + Visualizer.MESSAGING_INTERVAL, loop.time())
+        await asyncio.sleep(nextSendTime - loop.time())
+
+    # if we have a serial object
+    if Visualizer.serialObject is not None:
+
+        # stop the motors before exit
+        await write_serial_message_async(Visualizer.get_stop_message)
+
+
+def open_serial_communication_task() -> SerialTaskHandle:
+    """Visualizer.serialCommunicationRunner - starts serial communication on the loop"""
+
+    return SerialTaskHandle(asyncio.run_coroutine_threadsafe(serial_communication_task(), loop))
+
+
+def on_serial_readable():
+    """prints any lines the arduino sends back"""
+
+    global serialReadBuffer
+
+    try:
+        data = os.read(serialFd, SERIAL_READ_SIZE)
+    except BlockingIOError:
+        return
+    except OSError:
+        loop.remove_reader(serialFd)
+        return
+
+    serialReadBuffer += data
+    while b"\n" in serialReadBuffer:
+        line, _, serialReadBuffer = serialReadBuffer.partition(b"\n")
+        print("Band:", line.decode('ascii', 'replace').rstrip())
+
+
+def start_serial_communication():
+    """sets up non-blocking reads and writes of the serial port"""
+
+    global serialFd
+    global serialExecutor
+    global serialWriteLock
+
+    serialWriteLock = asyncio.Lock()
+    serialFd = get_serial_fd()
+
+    if serialFd is not None:
+        os.set_blocking(serialFd, False)
+        loop.add_reader(serialFd, on_serial_readable)
+    elif Visualizer.serialObject is not None:
+        serialExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=Visualizer.SERIAL_THREAD_NAME)
+
+
+def stop_serial_communication():
+    """stops reading the serial port"""
+
+    if serialFd is not None:
+        loop.remove_reader(serialFd)
+    if serialExecutor is not None:
+        serialExecutor.shutdown()
+
+
+# =================================
+# TELEMETRY
+# =================================
+async def on_telemetry_client(reader, writer):
+    """keeps track of a connected telemetry client until it disconnects"""
+
+    telemetryWriters.append(writer)
+    try:
+        while len(await reader.read(SERIAL_READ_SIZE)) > 0:
+            pass
+    finally:
+        if writer in telemetryWriters:
+            telemetryWriters.remove(writer)
+        writer.close()
+
+
+def publish_telemetry():
+    """sends this frame's user and goal positions to every telemetry client"""
+
+    if len(telemetryWriters) == 0:
+        return
+
+    line = format("%d,%f,%f,%d\n" % (frameTicks, Visualizer.targetUser, Visualizer.targetGoal,
+                                     Visualizer.goalTestActive)).encode('ascii')
+    for writer in list(telemetryWriters):
+
+        # drop clients that can't keep up rather than buffering without bound
+        if writer.transport.get_write_buffer_size() > TELEMETRY_MAX_BUFFER:
+            telemetryWriters.remove(writer)
+            writer.close()
+        else:
+            writer.write(line)
+
+
+async def start_telemetry():
+    """starts the telemetry server, if enabled"""
+
+    global telemetryServer
+
+    if Visualizer.telemetryPort is not None:
+        telemetryServer = await asyncio.start_server(on_telemetry_client, TELEMETRY_HOST, Visualizer.telemetryPort)
+        print("Streaming telemetry on", TELEMETRY_HOST, Visualizer.telemetryPort)
+
+
+async def stop_telemetry():
+    """disconnects telemetry clients and stops the server"""
+
+    for writer in telemetryWriters:
+        writer.close()
+    if telemetryServer is not None:
+        telemetryServer.close()
+        await telemetryServer.wait_closed()
+
+
+# =================================
+# GENERAL
+# =================================
+def run_frame() -> bool:
+    """runs one frame of Visualizer (on the pygame thread), returns False when it's time to quit"""
+
+    global frameTicks
+
+    # handle input here
+    if Visualizer.process_input() == 0:
+        return False
+
+    # updates
+    Visualizer.update_logic()
+    Visualizer.update_draw()
+
+    # boilerplate (the loop does the frame timing; tick just measures it for input scaling)
+    pygame.display.update()
+    Visualizer.clock.tick()
+    frameTicks = pygame.time.get_ticks()
+
+    return True
+
+
+async def run_frames():
+    """runs frames at FRAME_RATE, scheduled against loop.time()"""
+
+    nextFrameTime = loop.time()
+
+    while await loop.run_in_executor(pygameExecutor, run_frame):
+        publish_telemetry()
+
+        # wait until the next frame is due (catching up rather than bursting if we fell behind)
+        nextFrameTime = max(nextFrameTime + FRAME_INTERVAL, loop.time())
+        await asyncio.sleep(nextFrameTime - loop.time())
+
+
+async def run():
+    """runs Visualizer with input, logic, serial and telemetry as cooperating tasks"""
+
+    global loop
+    global pygameExecutor
+
+    loop = asyncio.get_event_loop()
+    pygameExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pygame")
+
+    # route Visualizer's serial communication through the loop
+    Visualizer.serialCommunicationRunner = open_serial_communication_task
+    Visualizer.serialMessageWriter = write_serial_message_from_thread
+
+    # initialization
+    await loop.run_in_executor(pygameExecutor, Visualizer.start)
+    start_serial_communication()
+    await start_telemetry()
+
+    try:
+        await run_frames()
+
+    finally:
+        # set test inactive before exit (writes logs on the pygame thread, off the loop)
+        await loop.run_in_executor(pygameExecutor, Visualizer.set_goal_test_active, False)
+
+        # close everything down
+        await stop_telemetry()
+        stop_serial_communication()
+        await loop.run_in_executor(pygameExecutor, Visualizer.close_serial_communication)
+        pygameExecutor.shutdown()
+
+
+def main(argv):
+    """This is the main loop"""
+
+    # parse command line
+    Visualizer.parse_command_line(argv)
+
+    asyncio.run(run())
+
+
+# =================================
+# STARTUP
+# =================================
+if __name__ == '__main__':
+    main(sys.argv[1:])
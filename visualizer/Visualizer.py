@@ -1,3 +1,4 @@
+from array import array
 import csv
 import platform
 import random
@@ -28,6 +29,24 @@ JOY_AXIS_SCALE = 0.0015
 # serial communication
 MESSAGING_INTERVAL = 1/FRAME_RATE  # seconds
 SERIAL_THREAD_NAME = "serial_thread"
+SERIAL_COMMAND_VALUES = ord('V')
+SERIAL_COMMAND_INTENSITY = ord('I')
+SERIAL_COMMAND_FREQUENCY = ord('F')
+SERIAL_COMMAND_WAVEFORMS = ord('W')
+# frequency mode waveforms (must match hse.ino)
+FREQ_MODE_PULSE_WIDTH = 50  # milliseconds
+FREQ_MODE_MS_PER_STEP = 4  # milliseconds between pulses per step below 255
+WAVEFORM_RAMP_TIME = 0  # milliseconds; above 0 the band glides between pulse rates instead of stepping
+WAVEFORM_REFRESH_INTERVAL = 1.0  # seconds; unchanged waveforms are resent this often in case the band missed them
+# serial tx journal
+TX_JOURNAL_CAPACITY = 8192  # entries; roughly two minutes of frames at 60 Hz
+# latency tracing
+LATENCY_TRACE_CAPACITY = 8192  # samples
+LATENCY_TRACE_OPTION = "trace"
+LATENCY_TRACE_STAGES = ['Poll', 'Queue', 'Format', 'Write', 'Total']
+# telemetry
+TELEMETRY_OPTION = "telemetry="
+MAX_TELEMETRY_PORT = 65535
 # colors
 COLOR_BACKGROUND = 20, 20, 40
 COLOR_GOAL_TEST_INACTIVE = 255, 0, 0
@@ -68,6 +87,31 @@ screen = None
 # serial communication
 serialObject = None
 serialCommunicationThread = None
+serialCommunicationRunner = None  # if set, starts serial communication instead of a thread; returns something to join()
+serialMessageWriter = None  # if set, writes (message, command, front, back) instead of serialObject.write
+serialWriteLock = threading.Lock()
+bandSignalMode = SIGNAL_MODE_INTENSITY
+lastWaveformsMessage = None  # the band already has these waveforms, so they needn't be resent...
+lastWaveformsSendTime = 0.0  # ...until WAVEFORM_REFRESH_INTERVAL after this
+# serial tx journal (preallocated so the send loop never allocates)
+txJournalTimes = array('d', bytes(8 * TX_JOURNAL_CAPACITY))
+txJournalDurations = array('d', bytes(8 * TX_JOURNAL_CAPACITY))
+txJournalCommands = array('B', bytes(TX_JOURNAL_CAPACITY))
+txJournalFronts = array('h', bytes(2 * TX_JOURNAL_CAPACITY))
+txJournalBacks = array('h', bytes(2 * TX_JOURNAL_CAPACITY))
+txJournalModes = array('B', bytes(TX_JOURNAL_CAPACITY))
+txJournalCount = 0
+txJournalStartTime = 0.0
+# latency tracing (input sample -> targetUser -> calculate_vibration_values -> serial write)
+latencyTracingEnabled = False
+lastInputPollTime = 0.0
+lastTracedInputTime = 0.0
+latencyTraceInputTimes = array('d', bytes(8 * LATENCY_TRACE_CAPACITY))
+latencyTracePollIntervals = array('d', bytes(8 * LATENCY_TRACE_CAPACITY))
+latencyTraceCalculateTimes = array('d', bytes(8 * LATENCY_TRACE_CAPACITY))
+latencyTraceWriteStartTimes = array('d', bytes(8 * LATENCY_TRACE_CAPACITY))
+latencyTraceWriteEndTimes = array('d', bytes(8 * LATENCY_TRACE_CAPACITY))
+latencyTraceCount = 0
 # input
 gamepad = None
 # testing
@@ -87,9 +131,14 @@ lastTestGoalSetTime = 0.0
 numLogsMade = 0
 # user
 targetUser = 0.5
+# (read time, poll interval, targetUser) of the input sample that last moved targetUser, published
+# together so the serial thread never pairs one sample's value with another's timestamps
+userInputSample = (0.0, 0.0, targetUser)
 # writer
 testLogDataRows = None
 outputFilePrefix = "DEFAULT"
+# telemetry (only AsyncVisualizer streams it)
+telemetryPort = None
 
 
 # =================================
@@ -176,10 +225,21 @@ def start_logging_data():
 
     global testLogDataRows
     global loggingStartTime
+    global txJournalStartTime
+    global txJournalCount
 
     # note when logging started
     loggingStartTime = pygame.time.get_ticks()
 
+    # start a fresh tx journal (dropping anything sent between tests, e.g. signal mode changes;
+    # each entry's Mode column still says which mode the band was in)
+    with serialWriteLock:
+        txJournalStartTime = time.perf_counter()
+        txJournalCount = 0
+
+    # start a fresh latency trace
+    start_latency_trace()
+
     # create object to hold log data for this test
     testLogDataRows = [['Time', 'Current', 'Target', 'Error']]
 
@@ -204,12 +264,19 @@ def write_data_and_stop_logging():
     elif motorMode == MOTOR_MODE_NONE:
         motorModeText = "None"
 
-    fileName = format("%s_%d_%s_%s_%s.csv" %
+    fileName = format("%s_%d_%s_%s_%s" %
                       (outputFilePrefix, numLogsMade, testModeText, signalModeText, motorModeText))
-    with open(fileName, 'w', newline='') as csvfile:
+    with open(fileName + ".csv", 'w', newline='') as csvfile:
         logWriter = csv.writer(csvfile)
         logWriter.writerows(testLogDataRows)
 
+    # write out what was actually sent to the band during the test
+    write_and_clear_tx_journal(fileName + "_tx.csv")
+
+    # write out input-to-actuation latencies, if we were tracing them
+    if latencyTracingEnabled:
+        write_latency_trace(fileName + "_latency.csv")
+
     # increment number of logs made
     numLogsMade = numLogsMade + 1
 
@@ -217,22 +284,271 @@ def write_data_and_stop_logging():
     testLogDataRows = None
 
 
+# =================================
+# SERIAL TX JOURNAL
+# =================================
+def grow_tx_journal():
+    """doubles the capacity of the tx journal arrays"""
+
+    for journalArray in (txJournalTimes, txJournalDurations, txJournalCommands,
+                         txJournalFronts, txJournalBacks, txJournalModes):
+        journalArray.extend(journalArray)
+
+
+def record_tx_journal_entry(sendTime: float, duration: float, command: int, front: int, back: int):
+    """records one transmitted command - caller must hold serialWriteLock"""
+
+    global txJournalCount
+
+    # make room if we've run out of preallocated entries
+    if txJournalCount >= len(txJournalTimes):
+        grow_tx_journal()
+
+    i = txJournalCount
+    txJournalTimes[i] = sendTime
+    txJournalDurations[i] = duration
+    txJournalCommands[i] = command
+    txJournalFronts[i] = front
+    txJournalBacks[i] = back
+    txJournalModes[i] = bandSignalMode
+    txJournalCount = i + 1
+
+
+def write_and_clear_tx_journal(fileName: str):
+    """writes the tx journal to file (times relative to logging start, in ms) and empties it"""
+
+    global txJournalCount
+
+    with serialWriteLock:
+        rows = [['Time', 'Command', 'Front', 'Back', 'Mode', 'WriteDuration']]
+        for i in range(txJournalCount):
+            modeText = "F" if txJournalModes[i] == SIGNAL_MODE_FREQUENCY else "I"
+            front = txJournalFronts[i]
+            back = txJournalBacks[i]
+            rows.append([format("%.3f" % ((txJournalTimes[i] - txJournalStartTime) * 1000.0)),
+                         chr(txJournalCommands[i]),
+                         "" if front < 0 else str(front),
+                         "" if back < 0 else str(back),
+                         modeText,
+                         format("%.3f" % (txJournalDurations[i] * 1000.0))])
+        txJournalCount = 0
+
+    with open(fileName, 'w', newline='') as csvfile:
+        logWriter = csv.writer(csvfile)
+        logWriter.writerows(rows)
+
+
+def note_serial_message_sent(message: bytearray, sendTime: float, duration: float, command: int, front: int, back: int):
+    """tracks the band's state and journals a sent message - caller must hold serialWriteLock"""
+
+    global bandSignalMode
+    global lastWaveformsMessage
+    global lastWaveformsSendTime
+
+    # track which signal mode the band is now in (switching modes resets its waveforms)
+    if command == SERIAL_COMMAND_FREQUENCY:
+        bandSignalMode = SIGNAL_MODE_FREQUENCY
+        lastWaveformsMessage = None
+    elif command == SERIAL_COMMAND_INTENSITY:
+        bandSignalMode = SIGNAL_MODE_INTENSITY
+        lastWaveformsMessage = None
+    elif command == SERIAL_COMMAND_WAVEFORMS:
+        lastWaveformsMessage = bytes(message)
+        lastWaveformsSendTime = sendTime
+
+    record_tx_journal_entry(sendTime, duration, command, front, back)
+
+
+def write_serial_message(getMessage) -> (float, float):
+    """writes the message from getMessage to the serial port and journals it, returns (start time, duration) of
+    the write, or None if getMessage returned None
+
+    getMessage returns (message, command, front, back) and is called while holding serialWriteLock,
+    so it sees the band's state as of this write"""
+
+    # let an alternative runtime (e.g. AsyncVisualizer) do the writing
+    if serialMessageWriter is not None:
+        return serialMessageWriter(getMessage)
+
+    with serialWriteLock:
+        toSend = getMessage()
+        if toSend is None:
+            return None
+        message, command, front, back = toSend
+
+        sendTime = time.perf_counter()
+        serialObject.write(message)
+        duration = time.perf_counter() - sendTime
+        note_serial_message_sent(message, sendTime, duration, command, front, back)
+
+    return (sendTime, duration)
+
+
+def get_vibration_message(frontValue: int, backValue: int) -> (bytearray, int, int, int):
+    """returns (message, command, front, back) that gives the band these values, or None if it already has them
+    - must be called while holding serialWriteLock"""
+
+    # in frequency mode the band schedules the pulses itself, so only send waveforms when they change
+    # (or now and then, in case a packet was lost or the band was reset)
+    if bandSignalMode == SIGNAL_MODE_FREQUENCY:
+        toSend = format_waveforms_for_serial_communication(calculate_waveform(frontValue),
+                                                           calculate_waveform(backValue))
+        if toSend == lastWaveformsMessage and \
+                time.perf_counter() - lastWaveformsSendTime < WAVEFORM_REFRESH_INTERVAL:
+            return None
+        return (toSend, SERIAL_COMMAND_WAVEFORMS, frontValue, backValue)
+
+    toSend = format_for_serial_communication(frontValue, backValue)
+    return (toSend, SERIAL_COMMAND_VALUES, frontValue, backValue)
+
+
+def get_stop_message() -> (bytearray, int, int, int):
+    """returns (message, command, front, back) that stops the motors - must be called while holding serialWriteLock"""
+
+    if bandSignalMode == SIGNAL_MODE_FREQUENCY:
+        toSend = format_waveforms_for_serial_communication((0, 0), (0, 0))
+        return (toSend, SERIAL_COMMAND_WAVEFORMS, 0, 0)
+
+    return (format_for_serial_communication(0, 0), SERIAL_COMMAND_VALUES, 0, 0)
+
+
+def send_vibration_values(frontValue: int, backValue: int) -> (float, float):
+    """sends front and back vibration values to the arduino, returns None if nothing needed sending"""
+
+    return write_serial_message(lambda: get_vibration_message(frontValue, backValue))
+
+
+def send_stop():
+    """stops the arduino's motors"""
+
+    write_serial_message(get_stop_message)
+
+
+def send_signal_mode(mode: int):
+    """tells the arduino which signal mode to use"""
+
+    command = SERIAL_COMMAND_FREQUENCY if mode == SIGNAL_MODE_FREQUENCY else SERIAL_COMMAND_INTENSITY
+    write_serial_message(lambda: (bytearray((command,)), command, -1, -1))
+
+
+# =================================
+# LATENCY TRACING
+# =================================
+def publish_user_input_sample(previousUser: float, pollTime: float):
+    """publishes targetUser, tagged with the time of the input sample that moved it, to the serial thread"""
+
+    global userInputSample
+    global lastInputPollTime
+
+    # only samples that actually changed targetUser can change what the band feels
+    if targetUser != previousUser:
+        userInputSample = (pollTime, pollTime - lastInputPollTime, targetUser)
+
+    lastInputPollTime = pollTime
+
+
+def start_latency_trace():
+    """clears the latency trace, ignoring any input made before now"""
+
+    global latencyTraceCount
+    global lastTracedInputTime
+
+    latencyTraceCount = 0
+    lastTracedInputTime = userInputSample[0]
+
+
+def record_latency_trace(inputTime: float, pollInterval: float, calculateTime: float, writeTiming: (float, float)):
+    """records the first transmission (writeTiming is its start time and duration) that reflects the input sample
+    read at inputTime - writeTiming is None if the band already reflected it, so nothing was sent"""
+
+    global latencyTraceCount
+    global lastTracedInputTime
+
+    # ignore samples that have already been sent (or didn't need sending)
+    if inputTime == lastTracedInputTime:
+        return
+    lastTracedInputTime = inputTime
+    if writeTiming is None:
+        return
+    writeStartTime, writeDuration = writeTiming
+
+    # make room if we've run out of preallocated samples
+    if latencyTraceCount >= len(latencyTraceInputTimes):
+        for traceArray in (latencyTraceInputTimes, latencyTracePollIntervals, latencyTraceCalculateTimes,
+                           latencyTraceWriteStartTimes, latencyTraceWriteEndTimes):
+            traceArray.extend(traceArray)
+
+    i = latencyTraceCount
+    latencyTraceInputTimes[i] = inputTime
+    latencyTracePollIntervals[i] = pollInterval
+    latencyTraceCalculateTimes[i] = calculateTime
+    latencyTraceWriteStartTimes[i] = writeStartTime
+    latencyTraceWriteEndTimes[i] = writeStartTime + writeDuration
+    latencyTraceCount = i + 1
+
+
+def get_latency_trace_rows() -> list:
+    """returns one row of stage latencies (ms, in LATENCY_TRACE_STAGES order) per traced sample"""
+
+    rows = []
+    for i in range(latencyTraceCount):
+        inputTime = latencyTraceInputTimes[i]
+        calculateTime = latencyTraceCalculateTimes[i]
+        writeStartTime = latencyTraceWriteStartTimes[i]
+        writeEndTime = latencyTraceWriteEndTimes[i]
+        rows.append([latencyTracePollIntervals[i] * 1000.0,  # how stale the sample could have been
+                     (calculateTime - inputTime) * 1000.0,  # waiting for the serial thread to wake
+                     (writeStartTime - calculateTime) * 1000.0,  # calculating and formatting values
+                     (writeEndTime - writeStartTime) * 1000.0,  # blocked in serialObject.write
+                     (writeEndTime - inputTime) * 1000.0])
+    return rows
+
+
+def percentile(sortedValues: list, p: float) -> float:
+    """nearest-rank percentile of an already sorted list"""
+
+    index = min(len(sortedValues) - 1, max(0, round(p / 100.0 * len(sortedValues)) - 1))
+    return sortedValues[index]
+
+
+def write_latency_trace(fileName: str):
+    """writes per-sample stage latencies to file and prints their distribution"""
+
+    rows = get_latency_trace_rows()
+
+    with open(fileName, 'w', newline='') as csvfile:
+        logWriter = csv.writer(csvfile)
+        logWriter.writerow(['Time'] + LATENCY_TRACE_STAGES)
+        for i in range(len(rows)):
+            elapsedTime = (latencyTraceInputTimes[i] - txJournalStartTime) * 1000.0
+            logWriter.writerow([format("%.3f" % value) for value in [elapsedTime] + rows[i]])
+
+    # summarize each stage
+    print("Latency (ms) over", len(rows), "input samples:")
+    for stageIndex in range(len(LATENCY_TRACE_STAGES)):
+        values = sorted(row[stageIndex] for row in rows)
+        if len(values) > 0:
+            print(format("  %-6s min %7.3f  median %7.3f  p95 %7.3f  max %7.3f" %
+                         (LATENCY_TRACE_STAGES[stageIndex], values[0], percentile(values, 50),
+                          percentile(values, 95), values[-1])))
+
+
 # =================================
 # THREADED SERIAL COMMUNICATION
 # =================================
-def calculate_vibration_values():
-    """calculates vibration values to pass to arduino"""
+def calculate_vibration_values(user: float):
+    """calculates vibration values to pass to arduino for a user position"""
 
     frontValue = 0
     backValue = 0
 
     if motorMode == MOTOR_MODE_EQUAL:
-        frontValue = round(255.0 * targetUser)
+        frontValue = round(255.0 * user)
         backValue = frontValue
 
     elif motorMode == MOTOR_MODE_OPPOSITE:
-        frontValue = round(255.0 * targetUser)
-        backValue = round(255.0 * (1 - targetUser))
+        frontValue = round(255.0 * user)
+        backValue = round(255.0 * (1 - user))
 
     return (frontValue, backValue)
 
@@ -259,6 +575,25 @@ def format_for_serial_communication(value1: int, value2: int) -> bytearray:
     return bytearray(format('{%s;%s}' % (value1Str, value2Str)), 'ascii')
 
 
+def calculate_waveform(value: int) -> (int, int):
+    """returns the (period in ms, duty out of 255) of frequency mode pulses for a vibration value"""
+
+    period = FREQ_MODE_PULSE_WIDTH + (255 - value) * FREQ_MODE_MS_PER_STEP
+    duty = (255 * FREQ_MODE_PULSE_WIDTH + period // 2) // period
+
+    return (period, duty)
+
+
+def format_waveforms_for_serial_communication(frontWaveform: (int, int), backWaveform: (int, int)) -> bytearray:
+    """takes (period, duty) waveforms for the two motors, formats for sending to arduino over serial
+
+    the leading 'F' puts a band that was reset back into frequency mode (it's ignored if already there)"""
+
+    return bytearray(format('F[%05d;%03d;%05d;%05d;%03d;%05d]' %
+                            (frontWaveform[0], frontWaveform[1], WAVEFORM_RAMP_TIME,
+                             backWaveform[0], backWaveform[1], WAVEFORM_RAMP_TIME)), 'ascii')
+
+
 def create_serial_communication_object():
     """creates object that will be used for communicating to arduino"""
 
@@ -303,6 +638,11 @@ def open_serial_communication_thread():
 
     global serialCommunicationThread
 
+    # let an alternative runtime (e.g. AsyncVisualizer) run the communication
+    if serialCommunicationRunner is not None:
+        serialCommunicationThread = serialCommunicationRunner()
+        return
+
     threading.Thread(name=SERIAL_THREAD_NAME, target=serial_communication_thread).start()
     threads = threading.enumerate()
     for thread in threads:
@@ -326,12 +666,19 @@ def serial_communication_thread():
     # so long as test is still active
     while goalTestActive and serialObject is not None:
 
+        # take the latest input sample
+        inputTime, pollInterval, user = userInputSample
+        calculateTime = time.perf_counter()
+
         # calculate what values to pass
-        frontValue, backValue = calculate_vibration_values()
+        frontValue, backValue = calculate_vibration_values(user)
+
+        # send the message (if the band doesn't already have it)
+        writeTiming = send_vibration_values(frontValue, backValue)
 
-        # send the message
-        toSend = format_for_serial_communication(frontValue, backValue)
-        serialObject.write(toSend)
+        # trace how long the input took to get here
+        if latencyTracingEnabled:
+            record_latency_trace(inputTime, pollInterval, calculateTime, writeTiming)
 
         # wait a bit
         time.sleep(MESSAGING_INTERVAL)
@@ -339,9 +686,8 @@ def serial_communication_thread():
     # if we have a serial object
     if serialObject is not None:
 
-        # set to 0's before exit
-        toSend = format_for_serial_communication(0, 0)
-        serialObject.write(toSend)
+        # stop the motors before exit
+        send_stop()
 
 
 # =================================
@@ -477,12 +823,12 @@ def set_goal_test_active(active: bool):
             # turn off the test
             goalTestActive = False
 
+            # wait for communication thread to close (so its final message is journaled)
+            wait_for_serial_communication_thread_close()
+
             # write out the log data
             write_data_and_stop_logging()
 
-            # wait for communication thread to close
-            wait_for_serial_communication_thread_close()
-
         # otherwise, if setting active from inactive (and there's no comms thread going)
         elif active and serialCommunicationThread is None:
 
@@ -660,6 +1006,10 @@ def process_input() -> int:
     global testMode
     global motorMode
 
+    # note when input was sampled, and where the user was beforehand
+    pollTime = time.perf_counter()
+    previousUser = targetUser
+
     # look at all current events
     for e in pygame.event.get():
 
@@ -679,9 +1029,7 @@ def process_input() -> int:
         if e.type == KEYUP and e.key == K_s:
             signalMode = (signalMode + 1) % SIGNAL_MODE_COUNT
             if serialObject is not None:
-                message = bytearray('F', 'ascii') if signalMode == SIGNAL_MODE_FREQUENCY \
-                    else bytearray('I', 'ascii')
-                serialObject.write(message)
+                send_signal_mode(signalMode)
 
         # change motor mode
         if e.type == KEYUP and e.key == K_m:
@@ -711,21 +1059,47 @@ def process_input() -> int:
             scaledValue = clock.get_time() * JOY_AXIS_SCALE * (abs(axis) - JOY_DEAD_ZONE)
             targetUser = min(max(targetUser + sign * scaledValue, 0), 1)
 
+    # hand the new targetUser to the serial thread
+    publish_user_input_sample(previousUser, pollTime)
+
     return 1
 
 
-def main(argv):
-    """This is the main loop"""
+def parse_command_line(argv):
+    """sets options from the command line"""
 
     global outputFilePrefix
     global numLogsMade
+    global latencyTracingEnabled
+    global telemetryPort
 
-    # parse command line
     if len(argv) > 0:
         outputFilePrefix = argv[0]
     if len(argv) > 1:
         numLogsMade = int(argv[1])
 
+    # any further arguments are options, in any order
+    for option in argv[2:]:
+        if option == LATENCY_TRACE_OPTION:
+            latencyTracingEnabled = True
+        elif option.startswith(TELEMETRY_OPTION):
+            port = option[len(TELEMETRY_OPTION):]
+            if port.isdigit() and 0 < int(port) <= MAX_TELEMETRY_PORT:
+                telemetryPort = int(port)
+            else:
+                print("ERROR: Bad telemetry port", port)
+        else:
+            print("ERROR: Unknown option", option)
+
+
+def main(argv):
+    """This is the main loop"""
+
+    # parse command line
+    parse_command_line(argv)
+    if telemetryPort is not None:
+        print("WARNING: Telemetry is only streamed by AsyncVisualizer.py, ignoring", TELEMETRY_OPTION)
+
     # initialization
     start()
 